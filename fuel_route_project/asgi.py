@@ -2,4 +2,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fuel_route_project.settings")
+# this process serves requests: load the stations table at startup (routeapi.apps)
+os.environ.setdefault("ROUTEAPI_PRELOAD_STATIONS", "1")
 application = get_asgi_application()
@@ -1,5 +1,48 @@
+import logging
+import os
+import sys
+
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
+# set to "1" by fuel_route_project/wsgi.py and asgi.py before Django starts, so
+# WSGI/ASGI server processes preload; export "0" to keep them lazy
+PRELOAD_ENV = "ROUTEAPI_PRELOAD_STATIONS"
+
+
 class RouteapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "routeapi"
+
+    def ready(self):
+        """
+        Load the stations table at startup so the first request doesn't pay for it.
+        Workers share one read-only copy through shared memory (see shared.py).
+        """
+        if not _should_preload(sys.argv):
+            return
+
+        from . import views
+        from .shared import shared_stations
+
+        if views.stations_cache is not None:
+            return
+
+        try:
+            # mapped from the segment another worker published, when there is one
+            views.stations_cache = shared_stations()
+        except Exception:
+            # route_plan retries the load and reports the error per request
+            logger.exception("Failed to preload stations CSV")
+
+
+def _should_preload(argv):
+    """Only processes that serve requests preload; commands, tests and shells stay lazy."""
+    flag = os.environ.get(PRELOAD_ENV)
+    if flag is not None:
+        return flag == "1"
+
+    # runserver's autoreloader parent only watches files; the child (RUN_MAIN) serves
+    command = argv[1] if len(argv) > 1 else None
+    return command == "runserver" and ("--noreload" in argv or os.environ.get("RUN_MAIN") == "true")
@@ -0,0 +1,72 @@
+# routeapi/kernels.py
+"""
+Distance kernels compiled with Numba when it is installed.
+Without Numba the same functions run as plain Python; callers check
+NUMBA_AVAILABLE to decide whether the loop kernels are worth using.
+"""
+import math
+import numpy as np
+
+R = 6371000.0
+DEG2RAD = math.pi / 180.0
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # numba is optional
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True, fastmath=True)
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Return great-circle distance in meters (scalar reference version)."""
+    phi1 = lat1 * DEG2RAD
+    phi2 = lat2 * DEG2RAD
+    s1 = math.sin((phi2 - phi1) * 0.5)
+    s2 = math.sin((lon2 - lon1) * (DEG2RAD * 0.5))
+    a = s1*s1 + math.cos(phi1)*math.cos(phi2)*s2*s2
+    # min() guards asin against rounding pushing a just past 1 for antipodal points
+    return 2.0 * R * math.asin(math.sqrt(min(a, 1.0)))
+
+
+@njit(cache=True)
+def cumulative_distances_nb(coords):
+    """coords: float64[:, :] of [lon, lat] rows. Returns cumulative meters."""
+    n = coords.shape[0]
+    cum = np.empty(n, dtype=np.float64)
+    cum[0] = 0.0
+    for i in range(1, n):
+        cum[i] = cum[i-1] + haversine_m(coords[i-1, 1], coords[i-1, 0], coords[i, 1], coords[i, 0])
+    return cum
+
+
+@njit(cache=True)
+def nearest_cheapest_nb(lat, lon, s_lat, s_lon, s_price, radius_m):
+    """
+    Index of the cheapest station within radius_m (ties broken by distance),
+    or of the nearest station when none is in range.
+    """
+    best = -1
+    best_price = 0.0
+    best_d = 0.0
+    nearest = -1
+    nearest_d = 0.0
+    for i in range(s_lat.shape[0]):
+        d = haversine_m(lat, lon, s_lat[i], s_lon[i])
+        if nearest < 0 or d < nearest_d:
+            nearest = i
+            nearest_d = d
+        if d <= radius_m:
+            p = s_price[i]
+            if best < 0 or p < best_price or (p == best_price and d < best_d):
+                best = i
+                best_price = p
+                best_d = d
+    if best >= 0:
+        return best
+    return nearest
@@ -0,0 +1,262 @@
+# routeapi/shared.py
+"""
+Share the stations table between worker processes through POSIX shared memory.
+
+Segments are named after the CSV's path, mtime and size, so a changed CSV gets
+fresh segments instead of reusing a stale one's name. A worker first tries to
+map a published segment; if there is none, it takes an flock on a lock file
+(released by the kernel if the holder dies), checks again, and only then parses
+the CSV and publishes it. Everyone else maps the same pages read-only.
+
+Header segment `<name>`:
+    int64[4]: ready flag, station count n, grid cell count m, names byte length
+Data segment `<name>_data`:
+    float64[n] lat | lon | price | lat_rad | lon_rad | cos_lat
+    int64[n] order | grid members
+    int64[m] grid keys | int64[m + 1] grid starts
+    int64[n + 1] name offsets | names, utf-8
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections.abc import Sequence
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+try:
+    import fcntl
+    import _posixshmem
+except ImportError:  # no flock (Windows): every worker loads its own copy
+    fcntl = None
+
+from .utils import Stations, StationGrid, load_stations, stations_csv_path
+
+logger = logging.getLogger(__name__)
+
+SHM_PREFIX = "stations_v1"
+HEADER_FIELDS = 4
+READY = 1
+# how long a worker waits for another one to finish publishing before loading privately
+LOCK_TIMEOUT_S = 30.0
+
+# keep the mappings alive for as long as this process uses the arrays
+_segments = []
+
+
+class SharedNames(Sequence):
+    """Station names decoded on access from the shared utf-8 blob."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        i = range(len(self))[i]
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+
+def shared_stations(csv_path: str = None) -> Stations:
+    """
+    Return the stations table mapped from shared memory, publishing it first
+    if no other process has. Falls back to a private load_stations() if
+    shared memory is unusable.
+    """
+    path = stations_csv_path(csv_path)
+    try:
+        name = segment_name(path)
+        stations = attach_stations(name)
+        if stations is None:
+            stations = _publish_locked(path, name)
+        if stations is not None:
+            return stations
+    except Exception:
+        logger.exception("Shared stations segment for %s unavailable", path)
+    return load_stations(path)
+
+
+def segment_name(csv_path: str) -> str:
+    """One segment per CSV file and version, so deployments and CSV updates never collide."""
+    st = os.stat(csv_path)
+    identity = f"{os.path.abspath(csv_path)}\0{st.st_mtime_ns}\0{st.st_size}"
+    return f"{SHM_PREFIX}_{hashlib.sha1(identity.encode()).hexdigest()[:12]}"
+
+
+def lock_path(csv_path: str) -> str:
+    """Lock file serializing publishers of one CSV; it also records the current segment name."""
+    digest = hashlib.sha1(os.path.abspath(csv_path).encode()).hexdigest()[:8]
+    return os.path.join(tempfile.gettempdir(), f"{SHM_PREFIX}_{digest}.lock")
+
+
+def _publish_locked(path: str, name: str) -> Optional[Stations]:
+    if fcntl is None:
+        return None
+
+    with open(lock_path(path), "a+") as lock:
+        if not _acquire(lock):
+            logger.warning("Timed out waiting to publish stations segment %s", name)
+            return None
+        try:
+            # whoever held the lock before us may have published it already
+            stations = attach_stations(name)
+            if stations is not None:
+                return stations
+
+            publish_stations(load_stations(path), name)
+
+            # drop the segments of the previous CSV version; workers mapping them keep their pages
+            lock.seek(0)
+            previous = lock.read().strip()
+            if previous and previous != name:
+                _unlink(previous)
+                _unlink(previous + "_data")
+            lock.truncate(0)
+            lock.write(name)
+            lock.flush()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return attach_stations(name)
+
+
+def _acquire(lock) -> bool:
+    deadline = time.monotonic() + LOCK_TIMEOUT_S
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+
+def attach_stations(name: str) -> Optional[Stations]:
+    """Map a published segment read-only; None if there is none or it isn't ready."""
+    try:
+        header_shm = _open(name)
+    except (FileNotFoundError, ValueError):
+        return None
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=header_shm.buf).copy()
+    header_shm.close()
+    if header[0] != READY:
+        return None
+
+    n, m, names_len = int(header[1]), int(header[2]), int(header[3])
+    shm = _open(name + "_data")
+    a = _layout(shm, n, m, names_len)
+    _segments.append(shm)
+
+    stations = Stations(
+        names=SharedNames(a["names"], a["name_offsets"]),
+        lat=a["lat"],
+        lon=a["lon"],
+        price=a["price"],
+        order=a["order"],
+        tree=None,  # the shared grid answers lookups; a BallTree would be a private copy
+    )
+    # pre-fill the lazily derived attributes with the shared arrays
+    vars(stations).update(
+        lat_rad=a["lat_rad"],
+        lon_rad=a["lon_rad"],
+        cos_lat=a["cos_lat"],
+        grid=StationGrid(keys=a["grid_keys"], starts=a["grid_starts"], members=a["grid_members"]),
+    )
+    return stations
+
+
+def publish_stations(stations: Stations, name: str) -> None:
+    """
+    Write `stations` to `<name>_data`, then create `<name>` and mark it ready.
+    Callers hold the publish lock, so anything already under these names was
+    left by a publisher that died and is safe to replace.
+    """
+    encoded = [s.encode("utf-8") for s in stations.names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    names = b"".join(encoded)
+    grid = StationGrid.build(stations.lat, stations.lon)
+    n, m = len(stations), len(grid.keys)
+
+    _unlink(name)
+    _unlink(name + "_data")
+
+    shm = _open(name + "_data", create=True, size=max(_data_size(n, m, len(names)), 1))
+    a = _layout(shm, n, m, len(names), writeable=True)
+    a["lat"][:] = stations.lat
+    a["lon"][:] = stations.lon
+    a["price"][:] = stations.price
+    a["lat_rad"][:] = np.radians(stations.lat)
+    a["lon_rad"][:] = np.radians(stations.lon)
+    a["cos_lat"][:] = np.cos(a["lat_rad"])
+    a["order"][:] = stations.order
+    a["grid_members"][:] = grid.members
+    a["grid_keys"][:] = grid.keys
+    a["grid_starts"][:] = grid.starts
+    a["name_offsets"][:] = offsets
+    a["names"][:] = np.frombuffer(names, dtype=np.uint8)
+    del a
+    shm.close()
+
+    header_shm = _open(name, create=True, size=HEADER_FIELDS * 8)
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=header_shm.buf)
+    header[1:] = (n, m, len(names))
+    header[0] = READY  # written last: readers only trust a complete segment
+    del header
+    header_shm.close()
+
+
+def _data_size(n: int, m: int, names_len: int) -> int:
+    return 8 * (8 * n + m + (m + 1) + (n + 1)) + names_len
+
+
+def _layout(shm: SharedMemory, n: int, m: int, names_len: int, writeable: bool = False):
+    specs = [
+        ("lat", np.float64, n), ("lon", np.float64, n), ("price", np.float64, n),
+        ("lat_rad", np.float64, n), ("lon_rad", np.float64, n), ("cos_lat", np.float64, n),
+        ("order", np.int64, n), ("grid_members", np.int64, n),
+        ("grid_keys", np.int64, m), ("grid_starts", np.int64, m + 1),
+        ("name_offsets", np.int64, n + 1), ("names", np.uint8, names_len),
+    ]
+    out = {}
+    offset = 0
+    for key, dtype, count in specs:
+        arr = np.ndarray((count,), dtype=dtype, buffer=shm.buf, offset=offset)
+        arr.flags.writeable = writeable
+        out[key] = arr
+        offset += arr.nbytes
+    return out
+
+
+def _open(name: str, create: bool = False, size: int = 0) -> SharedMemory:
+    """
+    Open (or create) a segment without tying it to this process's resource
+    tracker, which would unlink it when the worker exits. Segments outlive
+    individual workers; the next CSV version's publisher removes them.
+    """
+    try:
+        return SharedMemory(name=name, create=create, size=size, track=False)  # Python 3.13+
+    except TypeError:
+        shm = SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _unlink(name: str) -> None:
+    # open tracked so unlink()'s own unregister stays balanced
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        # never sized: its creator died between shm_open and ftruncate
+        _posixshmem.shm_unlink("/" + name)
+        return
+    shm.close()
+    shm.unlink()
@@ -1,7 +1,412 @@
-from django.test import TestCase, Client
+import dataclasses
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import time
+from multiprocessing.shared_memory import SharedMemory
+from unittest import mock
+
+import numpy as np
+import orjson
+
+from django.apps import apps
+from django.core.cache import cache
+from django.test import TestCase, Client, SimpleTestCase
+
+from . import shared, utils, views
+from .apps import PRELOAD_ENV, _should_preload
+from .kernels import cumulative_distances_nb, nearest_cheapest_nb
+from .utils import (
+    haversine_m, haversine_m_vec, cumulative_distances,
+    find_station_for_point, compute_stops, make_stations, load_stations,
+)
+
 
 class RouteAPITest(TestCase):
     def test_post_requires_json(self):
         c = Client()
         resp = c.post("/api/route/", data="notjson", content_type="application/json")
         self.assertEqual(resp.status_code, 400)
+
+
+class PreloadStationsTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(PRELOAD_ENV, None)
+        os.environ.pop("RUN_MAIN", None)
+
+    def test_should_preload(self):
+        self.assertFalse(_should_preload(["manage.py", "migrate"]))
+        self.assertFalse(_should_preload(["manage.py", "loaddata", "x.json"]))
+        self.assertFalse(_should_preload(["pytest"]))
+        self.assertFalse(_should_preload(["manage.py", "runserver"]))
+        self.assertTrue(_should_preload(["manage.py", "runserver", "--noreload"]))
+
+        os.environ["RUN_MAIN"] = "true"
+        self.assertTrue(_should_preload(["manage.py", "runserver"]))
+
+        # set by wsgi.py / asgi.py
+        os.environ[PRELOAD_ENV] = "1"
+        self.assertTrue(_should_preload(["gunicorn", "fuel_route_project.wsgi"]))
+        os.environ[PRELOAD_ENV] = "0"
+        self.assertFalse(_should_preload(["gunicorn", "fuel_route_project.wsgi"]))
+
+    @mock.patch("routeapi.views.stations_cache", None)
+    @mock.patch("routeapi.shared.shared_stations")
+    def test_ready_loads_stations_once(self, load):
+        config = apps.get_app_config("routeapi")
+        os.environ[PRELOAD_ENV] = "1"
+        with mock.patch("sys.argv", ["gunicorn"]):
+            config.ready()
+            config.ready()
+        load.assert_called_once_with()
+        self.assertIs(views.stations_cache, load.return_value)
+
+
+class GeocodeCacheTest(SimpleTestCase):
+    def setUp(self):
+        views._geocode_cached.cache_clear()
+        cache.clear()
+        self.addCleanup(views._geocode_cached.cache_clear)
+        self.addCleanup(cache.clear)
+
+    @mock.patch.dict(os.environ, {"LOCATIONIQ_KEY": "test"})
+    @mock.patch("routeapi.views.HTTP.get")
+    def test_repeat_addresses_hit_the_network_once(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = [{"lat": "40.5", "lon": "-100.25"}]
+
+        self.assertEqual(views.geocode_address("Denver,  CO"), (40.5, -100.25))
+        self.assertEqual(views.geocode_address(" denver, co "), (40.5, -100.25))
+        self.assertEqual(get.call_count, 1)
+        # the provider sees what the caller typed, not the cache key
+        self.assertEqual(get.call_args.kwargs["params"]["q"], "Denver,  CO")
+
+        # a fresh process (empty lru_cache) still finds it in the shared cache
+        views._geocode_cached.cache_clear()
+        self.assertEqual(views.geocode_address("Denver, CO"), (40.5, -100.25))
+        self.assertEqual(get.call_count, 1)
+
+
+    @mock.patch.dict(os.environ, {"LOCATIONIQ_KEY": "test"})
+    @mock.patch("routeapi.views.HTTP.get")
+    def test_not_found_reports_original_address(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = []
+
+        with self.assertRaisesMessage(ValueError, "Address not found: Nowhere, ZZ"):
+            views.geocode_address("Nowhere, ZZ")
+
+
+class RouteCacheTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @mock.patch("routeapi.views.stations_cache", make_stations(["A"], [40.0], [-100.0], [3.0]))
+    @mock.patch("routeapi.views.geocode_address", side_effect={"A": (40.0, -100.0), "B": (40.5, -100.5)}.get)
+    @mock.patch("routeapi.views.HTTP.get")
+    def test_same_endpoints_route_once(self, get, _geocode):
+        get.return_value.content = orjson.dumps({"routes": [{
+            "distance": 70000.0,
+            "duration": 3600.0,
+            "geometry": {"type": "LineString", "coordinates": [[-100.0, 40.0], [-100.5, 40.5]]},
+        }]})
+        body = '{"start": "A", "finish": "B"}'
+
+        first = self.client.post("/api/route/", data=body, content_type="application/json")
+        second = self.client.post("/api/route/", data=body, content_type="application/json")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(get.call_count, 1)
+
+
+class GeoUtilsTest(SimpleTestCase):
+    def setUp(self):
+        self.stations = make_stations(
+            names=["PRICEY NEAR", "CHEAP FAR", "CHEAP NEAR"],
+            lats=[40.0, 40.0, 40.1],
+            lons=[-100.0, -99.0, -100.0],
+            prices=[4.00, 2.50, 3.00],
+        )
+
+    def test_make_stations_sorts_by_price(self):
+        self.assertEqual(self.stations.names, ["CHEAP FAR", "CHEAP NEAR", "PRICEY NEAR"])
+        self.assertEqual(list(self.stations.order), [1, 2, 0])
+
+    def test_haversine_vec_matches_scalar(self):
+        lats = [40.0, 41.5, 35.2]
+        lons = [-100.0, -90.0, -120.3]
+        d = haversine_m_vec(39.0, -95.0, lats, lons)
+        for i in range(3):
+            self.assertAlmostEqual(d[i], haversine_m(39.0, -95.0, lats[i], lons[i]), places=3)
+
+    def test_cumulative_distances(self):
+        coords = [[-100.0, 40.0], [-100.0, 41.0], [-100.0, 42.0]]
+        cum = cumulative_distances(coords)
+        self.assertEqual(cum[0], 0.0)
+        self.assertAlmostEqual(cum[1], haversine_m(40.0, -100.0, 41.0, -100.0), places=3)
+        self.assertAlmostEqual(cum[2], 2 * cum[1], places=3)
+
+    def test_find_station_prefers_cheapest_in_radius(self):
+        idx = find_station_for_point(40.0, -100.0, self.stations, radius_m=50000)
+        self.assertEqual(self.stations.names[idx], "CHEAP NEAR")
+
+    def test_find_station_falls_back_to_nearest(self):
+        idx = find_station_for_point(45.0, -100.0, self.stations, radius_m=1000)
+        self.assertEqual(self.stations.names[idx], "CHEAP NEAR")
+
+    def test_find_station_linear_matches_tree(self):
+        linear = dataclasses.replace(self.stations, tree=None)
+        for lat, lon, radius in [(40.0, -100.0, 50000), (45.0, -100.0, 1000), (40.0, -99.2, 30000)]:
+            self.assertEqual(
+                find_station_for_point(lat, lon, linear, radius),
+                find_station_for_point(lat, lon, self.stations, radius),
+            )
+
+    def test_grid_candidates(self):
+        lats, lons = np.meshgrid(np.arange(30.0, 40.0), np.arange(-100.0, -90.0))
+        grid = make_stations([f"{a},{b}" for a, b in zip(lats.ravel(), lons.ravel())],
+                             lats.ravel(), lons.ravel(), np.ones(lats.size))
+
+        near = {grid.names[i] for i in grid.candidates(35.2, -95.2, 0.4, 0.4)}
+        self.assertEqual(near, {"35.0,-95.0", "35.0,-96.0"})
+        self.assertEqual(len(grid.candidates(10.0, -60.0, 0.4, 0.4)), 0)
+
+    def test_kernels_match_numpy(self):
+        coords = np.array([[-100.0, 40.0], [-99.5, 40.3], [-99.0, 41.0]])
+        expected = np.concatenate(([0.0], np.cumsum(haversine_m_vec(
+            coords[:-1, 1], coords[:-1, 0], coords[1:, 1], coords[1:, 0]))))
+        np.testing.assert_allclose(cumulative_distances_nb(coords), expected, rtol=1e-9)
+
+        s = self.stations
+        for lat, lon, radius in [(40.0, -100.0, 50000), (45.0, -100.0, 1000)]:
+            self.assertEqual(
+                nearest_cheapest_nb(lat, lon, s.lat, s.lon, s.price, radius),
+                find_station_for_point(lat, lon, s, radius),
+            )
+
+    def test_compute_stops_uses_router_distance(self):
+        coords = [[-100.0, 30.0 + i * 0.1] for i in range(161)]
+        with mock.patch.object(utils, "cumulative_distances") as cum:
+            result = compute_stops(coords, self.stations, total_distance_m=100000.0)
+        cum.assert_not_called()
+        self.assertEqual(result["total_distance_m"], 100000.0)
+        self.assertEqual(result["stops"], [])
+
+        # along-route distances are scaled to the router's length
+        result = compute_stops(coords, self.stations, total_distance_m=2000000.0)
+        self.assertEqual(result["total_distance_m"], 2000000.0)
+        self.assertEqual(len(result["stops"]), 2)
+
+    def test_compute_stops_degenerate_geometry(self):
+        # router length over one tank, but every point is the same
+        result = compute_stops([[-100.0, 30.0]] * 3, self.stations, total_distance_m=2000000.0)
+        self.assertEqual(result["stops"], [])
+        self.assertEqual(result["total_distance_m"], 0.0)
+
+        result = compute_stops([], self.stations, total_distance_m=100000.0)
+        self.assertEqual(result["total_distance_m"], 100000.0)
+        self.assertGreater(result["total_gallons"], 0)
+
+    def test_compute_stops_long_route(self):
+        # ~1100 miles due north, needs two stops
+        coords = [[-100.0, 30.0 + i * 0.1] for i in range(161)]
+        result = compute_stops(coords, self.stations)
+        self.assertEqual(len(result["stops"]), 2)
+        self.assertGreater(result["estimated_cost"], 0)
+        self.assertIn("price", result["stops"][0]["station"])
+
+
+class LoadStationsTest(SimpleTestCase):
+    CSV = (
+        "Station Name,Latitude,Longitude,Price\n"
+        "A,40.0,-100.0,3.10\n"
+        "B,41.0,-101.0,2.90\n"
+        "C,bad,-102.0,3.50\n"
+    )
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "stations.csv")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(self.CSV)
+
+    def test_load_stations(self):
+        stations = load_stations(self.path)
+        self.assertEqual(stations.names, ["B", "A"])
+        self.assertEqual(list(stations.price), [2.90, 3.10])
+
+    def test_pandas_fallback_matches_arrow(self):
+        stations = load_stations(self.path)
+        if os.path.exists(self.path + ".parquet"):
+            os.remove(self.path + ".parquet")
+        with mock.patch.object(utils, "pa_csv", None):
+            fallback = load_stations(self.path)
+        self.assertEqual(fallback.names, stations.names)
+        np.testing.assert_array_equal(fallback.lat, stations.lat)
+
+    def test_load_stations_latin1_semicolons(self):
+        with open(self.path, "w", encoding="latin-1") as f:
+            f.write(self.CSV.replace(",", ";").replace("A;", "Café Señor;"))
+        stations = load_stations(self.path)
+        self.assertEqual(stations.names, ["B", "Café Señor"])
+
+    def write_late_latin1(self):
+        # ASCII for well past the 64 KB sniffed prefix, one Latin-1 row at the end
+        rows = [f"S{i:04d} PADDING PADDING PADDING,{40 + i * 0.001:.4f},-100.0,3.50" for i in range(2500)]
+        rows.append("Café Señor,41.0,-101.0,2.50")
+        with open(self.path, "w", encoding="latin-1") as f:
+            f.write("Station Name,Latitude,Longitude,Price\n" + "\n".join(rows) + "\n")
+
+    def test_load_stations_latin1_after_prefix_pandas(self):
+        self.write_late_latin1()
+        with mock.patch.object(utils, "pa_csv", None):
+            stations = load_stations(self.path)
+        self.assertEqual(stations.names[0], "Café Señor")
+
+    def test_load_stations_latin1_after_prefix(self):
+        self.write_late_latin1()
+        stations = load_stations(self.path)
+        self.assertEqual(stations.names[0], "Café Señor")
+
+    def test_sidecar_is_reused_until_csv_changes(self):
+        load_stations(self.path)
+        sidecar = self.path + ".parquet"
+        if not os.path.exists(sidecar):
+            self.skipTest("no parquet engine installed")
+
+        # sidecar newer than CSV: served from the cache
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("D,42.0,-103.0,1.00\n")
+        os.utime(self.path, (0, 0))
+        self.assertEqual(len(load_stations(self.path)), 2)
+
+        # CSV touched after the sidecar: re-parsed
+        os.utime(self.path, None)
+        os.utime(sidecar, (0, 0))
+        self.assertEqual(len(load_stations(self.path)), 3)
+
+
+def _boot_worker(path, loads):
+    # stands in for a WSGI worker starting up; counts real CSV parses
+    def counting_load(csv_path):
+        with loads.get_lock():
+            loads.value += 1
+        return load_stations(csv_path)
+
+    with mock.patch.object(shared, "load_stations", counting_load):
+        stations = shared.shared_stations(path)
+    os._exit(0 if isinstance(stations.names, shared.SharedNames) else 1)
+
+
+def _die_holding_claim(path, name):
+    # a publisher killed mid-load: lock taken, header created but never marked ready
+    lock = open(shared.lock_path(path), "a+")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    shared._open(name, create=True, size=shared.HEADER_FIELDS * 8)
+    os._exit(0)
+
+
+class SharedStationsTest(SimpleTestCase):
+    def setUp(self):
+        self.name = f"stations_test_{os.getpid()}"
+        self.segments = {self.name}
+        self.addCleanup(self._unlink)
+        self.stations = make_stations(["A", "Bé", "C"], [40.0, 41.0, 42.0], [-100.0, -101.0, -102.0], [3.0, 2.0, 4.0])
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "stations.csv")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(LoadStationsTest.CSV)
+        self.segments.add(shared.segment_name(self.path))
+
+    def _unlink(self):
+        for name in self.segments:
+            for segment in (name, name + "_data"):
+                try:
+                    shm = SharedMemory(name=segment)
+                except FileNotFoundError:
+                    continue
+                shm.close()
+                shm.unlink()
+        if os.path.exists(shared.lock_path(self.path)):
+            os.remove(shared.lock_path(self.path))
+
+    def update_csv(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("D,42.0,-103.0,1.00\n")
+        os.utime(self.path, None)
+        self.segments.add(shared.segment_name(self.path))
+
+    def boot_workers(self, count):
+        ctx = multiprocessing.get_context("fork")
+        loads = ctx.Value("i", 0)
+        workers = [ctx.Process(target=_boot_worker, args=(self.path, loads)) for _ in range(count)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join(30)
+        self.assertEqual([w.exitcode for w in workers], [0] * count)
+        return loads.value
+
+    def test_publish_then_attach(self):
+        shared.publish_stations(self.stations, self.name)
+        attached = shared.attach_stations(self.name)
+
+        self.assertEqual(list(attached.names), self.stations.names)
+        np.testing.assert_array_equal(attached.lat, self.stations.lat)
+        np.testing.assert_array_equal(attached.price, self.stations.price)
+        np.testing.assert_array_equal(attached.order, self.stations.order)
+        np.testing.assert_array_equal(attached.cos_lat, self.stations.cos_lat)
+        self.assertFalse(attached.lat.flags.writeable)
+        self.assertIsNone(attached.tree)
+        self.assertEqual(find_station_for_point(41.0, -101.0, attached, 50000), 0)
+
+    def test_unpublished_segment_is_ignored(self):
+        self.assertIsNone(shared.attach_stations(self.name))
+        shared._open(self.name, create=True, size=shared.HEADER_FIELDS * 8).close()
+        self.assertIsNone(shared.attach_stations(self.name))
+
+    def test_shared_stations_loads_once_until_csv_changes(self):
+        with mock.patch.object(shared, "load_stations", wraps=load_stations) as load:
+            first = shared.shared_stations(self.path)
+            second = shared.shared_stations(self.path)
+            self.assertEqual(load.call_count, 1)
+            self.assertEqual(list(second.names), list(first.names))
+
+            old_name = shared.segment_name(self.path)
+            self.update_csv()
+            third = shared.shared_stations(self.path)
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(third.names[0], "D")
+        # the previous version's segment is gone; first and second still read their pages
+        self.assertIsNone(shared.attach_stations(old_name))
+        self.assertEqual(first.names[0], "B")
+
+    def test_dead_publisher_is_recovered(self):
+        ctx = multiprocessing.get_context("fork")
+        claimant = ctx.Process(target=_die_holding_claim, args=(self.path, shared.segment_name(self.path)))
+        claimant.start()
+        claimant.join(30)
+
+        started = time.monotonic()
+        stations = shared.shared_stations(self.path)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIsInstance(stations.names, shared.SharedNames)
+
+    def test_concurrent_boot_parses_once(self):
+        self.assertEqual(self.boot_workers(6), 1)
+        # the segment outlives the workers for the next one to attach
+        self.assertIsNotNone(shared.attach_stations(shared.segment_name(self.path)))
+
+    def test_concurrent_boot_after_csv_change_parses_once(self):
+        shared.shared_stations(self.path)
+        self.update_csv()
+        self.assertEqual(self.boot_workers(8), 1)
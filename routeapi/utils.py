@@ -1,71 +1,296 @@
-import math
-from typing import List, Dict
+from dataclasses import dataclass
+from functools import cached_property
+from typing import List, Dict, Optional, Tuple
+import csv
+import chardet
+import numpy as np
 import pandas as pd
 import os
 
+try:
+    import pyarrow.csv as pa_csv
+    import pyarrow.types as pa_types
+except ImportError:  # pyarrow is optional; pandas parses the CSV instead
+    pa_csv = None
 
-def haversine_m(lat1, lon1, lat2, lon2):
-    """Return great-circle distance in meters."""
-    R = 6371000.0
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
+try:
+    from sklearn.neighbors import BallTree
+except ImportError:  # scikit-learn is optional; fall back to linear scans
+    BallTree = None
+
+from .kernels import NUMBA_AVAILABLE, haversine_m, cumulative_distances_nb, nearest_cheapest_nb
+
+EARTH_RADIUS_M = 6371000.0
+# station grid resolution: 2 cells per degree -> 0.5 x 0.5 degree cells
+GRID_CELLS_PER_DEG = 2
+# cell (row, col) is encoded as row * GRID_KEY_STRIDE + col, which sorts row-major
+GRID_KEY_STRIDE = 1 << 32
+
+
+def haversine_m_vec(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Vectorized great-circle distance in meters.
+    Arguments broadcast against each other, so this covers both
+    one-point-vs-many (station scans) and pairwise (polyline segments).
+    """
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return EARTH_RADIUS_M * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+@dataclass
+class Stations:
+    """
+    Station table stored as parallel arrays (sorted by price, cheapest first).
+    `order` maps each entry back to its position among the loaded rows.
+    """
+    names: List[str]
+    lat: np.ndarray
+    lon: np.ndarray
+    price: np.ndarray
+    order: np.ndarray
+    tree: Optional["BallTree"] = None
+
+    def __post_init__(self):
+        # shared read-only across requests (and across workers, see shared.py)
+        for arr in (self.lat, self.lon, self.price, self.order):
+            arr.flags.writeable = False
+
+    # derived on first use (only the no-BallTree lookup needs them) so radius
+    # queries don't redo the trig per station
+    @cached_property
+    def lat_rad(self) -> np.ndarray:
+        return np.radians(self.lat)
+
+    @cached_property
+    def lon_rad(self) -> np.ndarray:
+        return np.radians(self.lon)
+
+    @cached_property
+    def cos_lat(self) -> np.ndarray:
+        return np.cos(self.lat_rad)
+
+    @cached_property
+    def grid(self) -> "StationGrid":
+        return StationGrid.build(self.lat, self.lon)
+
+    def candidates(self, lat: float, lon: float, dlat_max: float, dlon_max: float) -> np.ndarray:
+        """Indices of stations in the grid cells overlapping the given lat/lon box."""
+        row, col = _grid_cell(lat, lon)
+        dr = int(np.ceil(dlat_max * GRID_CELLS_PER_DEG))
+        dc = int(np.ceil(dlon_max * GRID_CELLS_PER_DEG))
+
+        grid = self.grid
+
+        # box spans more cells than exist: a plain scan is cheaper
+        if (2 * dr + 1) * (2 * dc + 1) > len(grid.keys):
+            return np.arange(len(self))
+
+        # the cells of one grid row are adjacent in key order: one slice per row
+        rows = np.arange(row - dr, row + dr + 1, dtype=np.int64) * GRID_KEY_STRIDE
+        lo = np.searchsorted(grid.keys, rows + (col - dc), side="left")
+        hi = np.searchsorted(grid.keys, rows + (col + dc), side="right")
+        hits = [grid.members[grid.starts[a]:grid.starts[b]] for a, b in zip(lo, hi) if b > a]
+        if not hits:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(hits))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def station(self, i: int) -> Dict:
+        """Materialize station `i` as the dict returned in API responses."""
+        return {
+            "name": self.names[i],
+            "lat": float(self.lat[i]),
+            "lon": float(self.lon[i]),
+            "price": float(self.price[i]),
+        }
+
+
+def _grid_cell(lat: float, lon: float) -> Tuple[int, int]:
+    return int(np.floor(lat * GRID_CELLS_PER_DEG)), int(np.floor(lon * GRID_CELLS_PER_DEG))
+
+
+@dataclass
+class StationGrid:
+    """
+    Stations bucketed into GRID_CELLS_PER_DEG cells, as flat arrays:
+    cell `keys[k]` holds stations `members[starts[k]:starts[k + 1]]`.
+    """
+    keys: np.ndarray
+    starts: np.ndarray
+    members: np.ndarray
+
+    @classmethod
+    def build(cls, lat: np.ndarray, lon: np.ndarray) -> "StationGrid":
+        cells = np.floor(np.c_[lat, lon] * GRID_CELLS_PER_DEG).astype(np.int64)
+        cell_keys = cells[:, 0] * GRID_KEY_STRIDE + cells[:, 1]
+        members = np.argsort(cell_keys, kind="stable")
+        keys, starts = np.unique(cell_keys[members], return_index=True)
+        return cls(keys=keys, starts=np.append(starts, len(members)), members=members)
 
 
 def meters_to_miles(m: float) -> float:
     return m / 1609.344
 
 
-def load_stations(csv_path: str = None) -> List[Dict]:
+def stations_csv_path(csv_path: str = None) -> str:
+    return csv_path or os.path.join(os.getcwd(), "fuel-prices-for-be-assessment.csv")
+
+
+def load_stations(csv_path: str = None) -> Stations:
     """
     SAFE + STABLE CSV LOADER
-    - Tries UTF-8
-    - If fails, tries Latin-1
-    - If fails, tries Windows-1252
-    - Tries multiple separators (comma, semicolon, tab, pipes)
-    - Auto-detects station name / lat / lon / price columns
+    - Reuses the `<csv>.parquet` sidecar if it is newer than the CSV
+    - Otherwise parses the CSV (see _read_stations_csv) and writes the sidecar
     """
 
-    default = os.path.join(os.getcwd(), "fuel-prices-for-be-assessment.csv")
-    path = csv_path or default
+    path = stations_csv_path(csv_path)
 
     if not os.path.exists(path):
         raise FileNotFoundError(f"Stations CSV not found at: {path}")
 
-    # ---- detect encoding safely ----
-    encodings = ["utf-8", "utf-8-sig", "latin-1", "cp1252"]
-    df = None
+    sidecar = path + ".parquet"
+    cols = _read_sidecar(sidecar, path)
+    if cols is None:
+        cols = _read_stations_csv(path)
+        _write_sidecar(cols, sidecar)
+
+    lat = _to_float(cols["lat"])
+    lon = _to_float(cols["lon"])
+    price = _to_float(cols["price"])
+    mask = ~(np.isnan(lat) | np.isnan(lon) | np.isnan(price))
+
+    if not mask.any():
+        raise ValueError("No valid station rows found in CSV.")
+
+    names = np.char.strip(np.asarray(cols["name"])[mask].astype(str)).tolist()
+
+    return make_stations(names, lat[mask], lon[mask], price[mask])
 
-    for enc in encodings:
+
+def _to_float(values) -> np.ndarray:
+    return np.asarray(pd.to_numeric(values, errors="coerce"), dtype=np.float64)
+
+
+def _read_sidecar(sidecar: str, csv_path: str) -> Optional[Dict[str, np.ndarray]]:
+    """Return the cached station columns, or None if missing or older than the CSV."""
+    try:
+        if os.path.getmtime(sidecar) < os.path.getmtime(csv_path):
+            return None
+        df = pd.read_parquet(sidecar)
+    except Exception:
+        return None
+    return {c: df[c].to_numpy() for c in ("name", "lat", "lon", "price")}
+
+
+def _write_sidecar(cols: Dict[str, np.ndarray], sidecar: str) -> None:
+    # best effort: needs pyarrow (or fastparquet) and a writable directory
+    try:
+        df = pd.DataFrame(cols)
+        df["name"] = df["name"].astype(str)
+        df.to_parquet(sidecar, index=False)
+    except Exception:
+        pass
+
+
+def _sniff_csv(path: str) -> Tuple[str, Optional[str]]:
+    """Guess (encoding, delimiter) from a prefix of the file."""
+    with open(path, "rb") as f:
+        head = f.read(65536)
+
+    enc = chardet.detect(head)["encoding"] or "utf-8"
+    # a pure-ASCII prefix says nothing about the rest of the file; utf-8 is a
+    # superset that still fails loudly on bytes it can't decode
+    if enc.lower() == "ascii":
+        enc = "utf-8"
+
+    try:
+        text = head.decode(enc, errors="replace")
+        delimiter = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t|").delimiter
+    except Exception:
+        delimiter = None
+    return enc, delimiter
+
+
+def _encoding_candidates(enc: str) -> List[str]:
+    """The detected encoding first, then cp1252 / latin-1 for non-UTF-8 bytes past the prefix."""
+    out = [enc]
+    for fallback in ("cp1252", "latin-1"):
+        if fallback not in (e.lower() for e in out):
+            out.append(fallback)
+    return out
+
+
+def _read_csv_arrow(path: str, enc: str, delimiter: Optional[str]):
+    """Parse with pyarrow's multi-threaded reader; None if unavailable or it fails."""
+    if pa_csv is None or delimiter is None:
+        return None
+    for candidate in _encoding_candidates(enc):
         try:
-            df = pd.read_csv(path, encoding=enc, engine="python")
-            break
+            table = pa_csv.read_csv(
+                path,
+                read_options=pa_csv.ReadOptions(encoding=candidate),
+                parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+            )
         except Exception:
-            df = None
-            continue
+            return None
+        # invalid UTF-8 text comes back as binary columns: wrong encoding, try the next
+        if not any(pa_types.is_binary(t) or pa_types.is_large_binary(t) for t in table.schema.types):
+            return table
+    return None
 
-    if df is None:
-        raise ValueError("Unable to decode CSV file using common encodings.")
 
-    # Try multiple separators if needed
-    if df.shape[1] == 1:
-        for sep in [",", ";", "\t", "|"]:
+def _read_stations_csv(path: str) -> Dict[str, np.ndarray]:
+    """
+    - Detects the encoding once from a prefix of the file (chardet)
+    - Sniffs the separator (comma, semicolon, tab, pipes, ...)
+    - Parses with pyarrow when available, pandas otherwise
+    - Auto-detects station name / lat / lon / price columns
+    Returns the raw name / lat / lon / price columns as numpy arrays.
+    """
+
+    enc, delimiter = _sniff_csv(path)
+
+    table = _read_csv_arrow(path, enc, delimiter)
+    if table is not None:
+        cols = [c.strip() for c in table.column_names]
+        table = table.rename_columns(cols)
+        first = table.slice(0, 1).to_pylist()[0] if table.num_rows else {}
+
+        def column(c):
+            return table.column(c).to_numpy(zero_copy_only=False)
+    else:
+        # sep=None lets the python engine sniff the delimiter; a decode error
+        # means the prefix guess was wrong, so retry with the next encoding
+        df = None
+        for candidate in _encoding_candidates(enc):
             try:
-                df = pd.read_csv(path, sep=sep, encoding=enc, engine="python")
-                if df.shape[1] > 1:
-                    break
-            except Exception:
+                df = pd.read_csv(path, encoding=candidate, sep=None, engine="python")
+                break
+            except UnicodeDecodeError:
                 continue
+            except Exception:
+                break
+
+        if df is None:
+            raise ValueError("CSV parsing failed — no readable columns found.")
+
+        cols = [c.strip() for c in df.columns]
+        df.columns = cols
+        first = df.iloc[0].to_dict() if len(df) else {}
+
+        def column(c):
+            return df[c].to_numpy()
 
-    if df is None or df.shape[1] < 2:
+    if len(cols) < 2:
         raise ValueError("CSV parsing failed — no readable columns found.")
 
     # Normalize header names
-    cols = [c.strip() for c in df.columns]
     lower = {c.lower(): c for c in cols}
 
     # Candidate column name options
@@ -89,7 +314,7 @@ def load_stations(csv_path: str = None) -> List[Dict]:
     numeric_cols = []
     for c in cols:
         try:
-            float(df.iloc[0][c])
+            float(first[c])
             numeric_cols.append(c)
         except Exception:
             continue
@@ -109,67 +334,143 @@ def load_stations(csv_path: str = None) -> List[Dict]:
         if name_col is None:
             name_col = cols[0]
 
-    stations = []
+    if lat_col is None or lon_col is None or price_col is None:
+        raise ValueError("Could not detect lat / lon / price columns in CSV.")
 
-    for _, row in df.iterrows():
-        try:
-            name = str(row[name_col]).strip()
-            lat = float(row[lat_col])
-            lon = float(row[lon_col])
-            price = float(row[price_col])
-            stations.append({"name": name, "lat": lat, "lon": lon, "price": price})
-        except Exception:
-            continue
+    return {
+        "name": column(name_col),
+        "lat": column(lat_col),
+        "lon": column(lon_col),
+        "price": column(price_col),
+    }
 
-    if not stations:
-        raise ValueError("No valid station rows found in CSV.")
 
-    stations.sort(key=lambda s: s["price"])
-    return stations
+def make_stations(names, lats, lons, prices) -> Stations:
+    """Build a price-sorted Stations table from parallel sequences."""
+    price = np.asarray(prices, dtype=np.float64)
+    order = np.argsort(price, kind="stable")
+    lat = np.asarray(lats, dtype=np.float64)[order]
+    lon = np.asarray(lons, dtype=np.float64)[order]
+
+    return Stations(
+        names=[names[i] for i in order],
+        lat=lat,
+        lon=lon,
+        price=price[order],
+        order=order,
+        tree=build_station_tree(lat, lon),
+    )
+
 
+def build_station_tree(lat: np.ndarray, lon: np.ndarray) -> Optional["BallTree"]:
+    """Haversine BallTree over the stations, or None without scikit-learn."""
+    if BallTree is None:
+        return None
+    return BallTree(np.radians(np.c_[lat, lon]), metric="haversine")
+
+
+
+def find_station_for_point(lat: float, lon: float, stations: Stations, radius_m: float = 50000) -> int:
+    """Return the index of the cheapest station within radius_m, else the nearest one."""
+    if stations.tree is not None:
+        return _find_station_tree(lat, lon, stations, radius_m)
+
+    # grid cells + bounding-box prefilter, exact haversine only on the survivors
+    dlat_max = np.degrees(radius_m / EARTH_RADIUS_M)
+    # widen the lon window using the box's poleward edge so it stays conservative
+    cos_edge = np.cos(np.radians(min(abs(lat) + dlat_max, 89.9)))
+    dlon_max = dlat_max / cos_edge
+    idxs = stations.candidates(lat, lon, dlat_max, dlon_max)
+    box = (np.abs(stations.lat[idxs] - lat) <= dlat_max) & (np.abs(stations.lon[idxs] - lon) <= dlon_max)
+    idxs = idxs[box]
+
+    if len(idxs):
+        d = _haversine_to(lat, lon, stations, idxs)
+        in_radius = d <= radius_m
+        if in_radius.any():
+            # cheapest within radius, ties broken by distance
+            idxs, d = idxs[in_radius], d[in_radius]
+            return int(idxs[np.lexsort((d, stations.price[idxs]))[0]])
+
+    # fallback: nearest station (nothing is within radius, so the kernel returns the nearest)
+    if NUMBA_AVAILABLE:
+        return int(nearest_cheapest_nb(lat, lon, stations.lat, stations.lon, stations.price, radius_m))
+    return int(np.argmin(haversine_m_vec(lat, lon, stations.lat, stations.lon)))
+
+
+def _haversine_to(lat: float, lon: float, stations: Stations, idxs: np.ndarray) -> np.ndarray:
+    """Haversine from (lat, lon) to stations[idxs], reusing the precomputed radians / cosines."""
+    phi1 = np.radians(lat)
+    dphi = stations.lat_rad[idxs] - phi1
+    dlambda = stations.lon_rad[idxs] - np.radians(lon)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * stations.cos_lat[idxs] * np.sin(dlambda / 2) ** 2
+    return EARTH_RADIUS_M * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
 
-def find_station_for_point(lat: float, lon: float, stations: List[Dict], radius_m: float = 50000) -> Dict:
-    candidates = []
-    for s in stations:
-        d = haversine_m(lat, lon, s["lat"], s["lon"])
-        if d <= radius_m:
-            candidates.append((d, s))
+def _find_station_tree(lat: float, lon: float, stations: Stations, radius_m: float) -> int:
+    point = np.radians([[lat, lon]])
+    idxs, dists = stations.tree.query_radius(point, r=radius_m / EARTH_RADIUS_M, return_distance=True)
+    idxs, dists = idxs[0], dists[0]
 
-    if candidates:
-        candidates.sort(key=lambda x: (x[1]["price"], x[0]))
-        return candidates[0][1]
+    if len(idxs):
+        # cheapest within radius, ties broken by distance
+        return int(idxs[np.lexsort((dists, stations.price[idxs]))[0]])
 
     # fallback: nearest station
-    stations_sorted = sorted(stations, key=lambda s: haversine_m(lat, lon, s["lat"], s["lon"]))
-    return stations_sorted[0]
+    _, nearest = stations.tree.query(point, k=1)
+    return int(nearest[0][0])
 
 
-def cumulative_distances(coords: List[List[float]]) -> List[float]:
-    cum = [0.0]
-    for i in range(1, len(coords)):
-        lon1, lat1 = coords[i-1]
-        lon2, lat2 = coords[i]
-        d = haversine_m(lat1, lon1, lat2, lon2)
-        cum.append(cum[-1] + d)
+def cumulative_distances(coords: List[List[float]]) -> np.ndarray:
+    arr = np.ascontiguousarray(coords, dtype=np.float64)
+    if NUMBA_AVAILABLE:
+        return cumulative_distances_nb(arr)
+
+    lons, lats = arr[:, 0], arr[:, 1]
+    cum = np.empty(len(arr), dtype=np.float64)
+    cum[0] = 0.0
+    np.cumsum(haversine_m_vec(lats[:-1], lons[:-1], lats[1:], lons[1:]), out=cum[1:])
     return cum
 
 
-def compute_stops(coords_geojson: List[List[float]], stations: List[Dict],
+def compute_stops(coords_geojson: List[List[float]], stations: Stations,
                   max_range_m: float = 500 * 1609.344, mpg: float = 10.0,
-                  radius_m: float = 50000) -> Dict:
+                  radius_m: float = 50000, total_distance_m: Optional[float] = None) -> Dict:
+    """
+    Greedy fuel plan along a [lon, lat] polyline.
+    total_distance_m: route length reported by the router (e.g. OSRM); when
+    given it is used as the trip length and along-route distances are scaled
+    to match it, and a trip that fits in one tank skips the distance pass.
+    """
+
+    # one contiguous [lon, lat] float64 array for the whole computation
+    coords = np.ascontiguousarray(coords_geojson, dtype=np.float64)
 
-    if not coords_geojson or len(coords_geojson) < 2:
+    if coords.ndim != 2 or len(coords) < 2:
+        # no geometry to place stops along; still report the router's length if we have it
+        total_distance_m = float(total_distance_m or 0.0)
         return {
-            "total_distance_m": 0.0,
-            "total_distance_miles": 0.0,
-            "total_gallons": 0.0,
+            "total_distance_m": round(total_distance_m, 2),
+            "total_distance_miles": round(meters_to_miles(total_distance_m), 3),
+            "total_gallons": round((total_distance_m / 1609.344) / mpg, 3),
             "stops": [],
             "estimated_cost": 0.0
         }
 
-    cum = cumulative_distances(coords_geojson)
-    total_distance_m = cum[-1]
+    cum = None
+    if total_distance_m is None:
+        cum = cumulative_distances(coords)
+        total_distance_m = float(cum[-1])
+    total_distance_m = float(total_distance_m)
+
+    if total_distance_m > max_range_m and cum is None:
+        cum = cumulative_distances(coords)
+        if cum[-1] > 0:
+            cum *= total_distance_m / cum[-1]
+        else:
+            # zero-length geometry (repeated points) can't be scaled; trust the geometry
+            total_distance_m = 0.0
+
     stops = []
     last_stop_dist_m = 0.0
     remaining_range = max_range_m
@@ -190,24 +491,24 @@ def compute_stops(coords_geojson: List[List[float]], stations: List[Dict],
         safe_counter += 1
 
         target_m = last_stop_dist_m + remaining_range
-        idx = next((i for i, v in enumerate(cum) if v >= target_m), len(cum)-1)
-        lon, lat = coords_geojson[idx]
+        idx = min(int(np.searchsorted(cum, target_m, side="left")), len(cum)-1)
+        lon, lat = float(coords[idx, 0]), float(coords[idx, 1])
 
-        station = find_station_for_point(lat, lon, stations, radius_m)
-        dist_remaining = total_distance_m - cum[idx]
+        station_idx = find_station_for_point(lat, lon, stations, radius_m)
+        dist_remaining = total_distance_m - float(cum[idx])
         fill_distance_m = min(dist_remaining, max_range_m)
         gallons = (fill_distance_m / 1609.344) / mpg
-        cost = gallons * station["price"]
+        cost = gallons * float(stations.price[station_idx])
 
         stops.append({
-            "station": station,
+            "station": stations.station(station_idx),
             "stop_coord": {"lat": lat, "lon": lon},
-            "distance_from_start_m": round(cum[idx], 2),
+            "distance_from_start_m": round(float(cum[idx]), 2),
             "gallons": round(gallons, 3),
             "cost": round(cost, 2)
         })
 
-        last_stop_dist_m = cum[idx]
+        last_stop_dist_m = float(cum[idx])
         remaining_range = max_range_m
 
     total_gallons = (total_distance_m / 1609.344) / mpg
@@ -1,42 +1,88 @@
 # routeapi/views.py
+from django.core.cache import cache
 from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
 import json
+import orjson
 import os
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from .utils import load_stations, compute_stops
 
 # Load environment variables
 load_dotenv()
 
-OSRM_ROUTE = "https://router.project-osrm.org/route/v1/driving/{coords}?overview=full&geometries=geojson"
+OSRM_ROUTE_URL = "https://router.project-osrm.org/route/v1/driving/"
+OSRM_ROUTE_QUERY = "?overview=full&geometries=geojson"
 
-# simple in-memory cache for stations (loaded once)
+GEOCODE_URL = "https://us1.locationiq.com/v1/search"
+GEOCODE_PARAMS_BASE = {"format": "json", "limit": 1, "countrycodes": "us"}
+GEOCODE_HEADERS = {"User-Agent": "fuel-route-service/1.0"}
+
+# one pooled keep-alive session for LocationIQ + OSRM (reuses TCP/TLS connections)
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+HTTP.headers.update(GEOCODE_HEADERS)
+
+# simple in-memory cache for stations (loaded once, utils.Stations)
 stations_cache = None
 
+# addresses don't move; keep geocodes around for ~30 days
+GEOCODE_CACHE_TTL = 30 * 24 * 3600
+ROUTE_CACHE_TTL = 24 * 3600
+
 
 # -----------------------------------------
 # GEOCODING USING LOCATIONIQ (SAFE + .env)
 # -----------------------------------------
 def geocode_address(address):
+    """
+    Return (lat, lon) for an address.
+    Results are memoized per process (lru_cache) and shared across
+    processes through Django's cache, keyed on the normalized address.
+    """
+    return _geocode_cached(_AddressKey(address))
+
+
+class _AddressKey(str):
+    """
+    The normalized address, which is what the caches compare and hash on,
+    carrying the caller's original spelling for LocationIQ and error messages.
+    """
+    def __new__(cls, address):
+        key = super().__new__(cls, " ".join(address.split()).lower())
+        key.original = address
+        return key
+
+
+@lru_cache(maxsize=4096)
+def _geocode_cached(address):
+    key = "geocode:" + hashlib.sha1(address.encode()).hexdigest()
+    hit = cache.get(key)
+    if hit is not None:
+        return tuple(hit)
+
+    result = _geocode_remote(address.original)
+    cache.set(key, result, GEOCODE_CACHE_TTL)
+    return result
+
+
+def _geocode_remote(address):
     API_KEY = os.getenv("LOCATIONIQ_KEY")
 
     if not API_KEY:
         raise ValueError("LOCATIONIQ_KEY missing in .env file")
 
-    # LocationIQ endpoint
-    url = "https://us1.locationiq.com/v1/search"
-
-    params = {
-        "key": API_KEY,
-        "q": address,
-        "format": "json",
-        "limit": 1,
-        "addressdetails": 1
-    }
-
-    r = requests.get(url, params=params, timeout=10)
+    r = HTTP.get(GEOCODE_URL, params={**GEOCODE_PARAMS_BASE, "key": API_KEY, "q": address}, timeout=10)
 
     if r.status_code == 401:
         raise ValueError("Invalid LocationIQ API key")
@@ -83,32 +129,40 @@ def route_plan(request):
         except Exception as e:
             return JsonResponse({"error": f"Failed to load stations CSV: {str(e)}"}, status=500)
 
-    # Geocode addresses
+    # Geocode addresses (both lookups in flight at once)
     try:
-        s_lat, s_lon = geocode_address(start)
-        f_lat, f_lon = geocode_address(finish)
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f1 = ex.submit(geocode_address, start)
+            f2 = ex.submit(geocode_address, finish)
+            s_lat, s_lon = f1.result()
+            f_lat, f_lon = f2.result()
     except Exception as e:
         return JsonResponse({"error": f"Geocoding failed: {str(e)}"}, status=400)
 
-    # Single OSRM route call
-    coords_param = f"{s_lon},{s_lat};{f_lon},{f_lat}"
+    # Single OSRM route call (cached per ~11 m endpoint pair)
+    route_key = f"osrm:{round(s_lat, 4)},{round(s_lon, 4)};{round(f_lat, 4)},{round(f_lon, 4)}"
+    route_obj = cache.get(route_key)
 
-    try:
-        r = requests.get(OSRM_ROUTE.format(coords=coords_param), timeout=15)
-        r.raise_for_status()
-    except Exception as e:
-        return JsonResponse({"error": f"Routing request failed: {str(e)}"}, status=500)
+    if route_obj is None:
+        try:
+            r = HTTP.get(f"{OSRM_ROUTE_URL}{s_lon},{s_lat};{f_lon},{f_lat}{OSRM_ROUTE_QUERY}", timeout=15)
+            r.raise_for_status()
+        except Exception as e:
+            return JsonResponse({"error": f"Routing request failed: {str(e)}"}, status=500)
+
+        route = orjson.loads(r.content)
+        if "routes" not in route or not route["routes"]:
+            return JsonResponse({"error": "No route returned by OSRM"}, status=500)
 
-    route = r.json()
-    if "routes" not in route or not route["routes"]:
-        return JsonResponse({"error": "No route returned by OSRM"}, status=500)
+        route_obj = route["routes"][0]
+        cache.set(route_key, route_obj, ROUTE_CACHE_TTL)
 
-    route_obj = route["routes"][0]
     geometry = route_obj.get("geometry", {})
     coords = geometry.get("coordinates", [])
 
     # Compute fuel stops
-    results = compute_stops(coords, stations_cache)
+    results = compute_stops(coords, stations_cache,
+                            total_distance_m=route_obj.get("distance"))
 
     response = {
         "start": {"address": start, "lat": s_lat, "lon": s_lon},
@@ -128,7 +182,10 @@ def route_plan(request):
         }
     }
 
-    return JsonResponse(response, safe=False)
+    return HttpResponse(
+        orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY),
+        content_type="application/json",
+    )
 
 
 def api_index(request):